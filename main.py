@@ -1,23 +1,81 @@
 import os
 from dotenv import load_dotenv
 from pathlib import Path
-from PIL import Image
-from fastapi import FastAPI, HTTPException, UploadFile, File, Query
+from PIL import Image, features
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 # Import necessary Telethon exceptions
 from telethon.errors.rpcerrorlist import SessionPasswordNeededError, PhoneCodeInvalidError, FloodWaitError
-from telethon import TelegramClient
-from telethon.tl.types import InputMessagesFilterPhotos, Channel
+from telethon.errors import UnauthorizedError
+from telethon import TelegramClient, utils
+from telethon.sessions import StringSession
+from telethon.tl.types import InputMessagesFilterPhotos, Channel, PhotoSize, PhotoSizeProgressive
 from telethon.tl.functions.channels import CreateChannelRequest, GetFullChannelRequest, DeleteChannelRequest
-from typing import List, Dict
+from pydantic import BaseModel
+from typing import List, Dict, Set, Optional, Iterable
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache
 import asyncio
+import diskcache
+import hashlib
+import itertools
 import io
+import json
+import orjson
+import time
+import uuid
 
 load_dotenv()
 # --- FastAPI App Initialization ---
-app = FastAPI(title="Telegram Gallery API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_group_cache()
+    await run_in_threadpool(_trim_full_cache)
+    await connect_clients()
+    yield
+    await disconnect_clients()
+
+app = FastAPI(title="Telegram Gallery API", lifespan=lifespan)
+
+# --- Response models ---
+# Declared on every JSON endpoint so FastAPI (>= 0.130) validates and serializes
+# the payload to JSON in one pass with pydantic-core.
+class StatusResponse(BaseModel):
+    status: str
+    message: Optional[str] = None
+
+class GroupCreated(BaseModel):
+    status: str
+    group_id: int
+    group_title: str
+
+class PhotosDeleted(BaseModel):
+    status: str
+    deleted: int
+
+class AuthStatus(BaseModel):
+    is_logged_in: bool
+
+class PhotoItem(BaseModel):
+    id: str
+    thumb_url: str
+
+class PhotoPage(BaseModel):
+    photos: List[PhotoItem]
+    has_more: bool
+
+class GroupItem(BaseModel):
+    id: int
+    title: str
+
+class GroupPage(BaseModel):
+    groups: List[GroupItem]
+    has_more: bool
 
 # --- CORS Middleware ---
 app.add_middleware(
@@ -26,6 +84,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 # --- App Configuration & Directory Setup ---
@@ -35,37 +94,236 @@ TG_API_HASH = os.environ.get("TG_API_HASH")
 if not TG_API_ID or not TG_API_HASH:
     raise ValueError("Please set TG_API_ID and TG_API_HASH environment variables.")
 
+TG_API_ID_INT = int(TG_API_ID)
+
 MEDIA_DIR = Path("media")
 THUMB_DIR = MEDIA_DIR / "thumbs"
-UPLOADS_DIR = Path("uploads") 
+CACHE_DIR = Path("cache")
+FULL_DIR = CACHE_DIR / "full"
+# When set (e.g. "/internal/media/"), /media is handed off to nginx via X-Accel-Redirect
+# so the proxy sends the file itself with sendfile(2).
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get("MEDIA_ACCEL_REDIRECT_PREFIX")
 MEDIA_DIR.mkdir(exist_ok=True)
 THUMB_DIR.mkdir(exist_ok=True)
-UPLOADS_DIR.mkdir(exist_ok=True)
+CACHE_DIR.mkdir(exist_ok=True)
+FULL_DIR.mkdir(exist_ok=True)
+
+# Pillow-SIMD (optional) reports versions like "9.5.0.post1"; stock Pillow has no ".post" suffix.
+if ".post" in Image.__version__:
+    print(f"Using Pillow-SIMD {Image.__version__} for image processing.")
+
+client = TelegramClient("telegram_session", TG_API_ID_INT, TG_API_HASH)
 
-client = TelegramClient("telegram_session", int(TG_API_ID), TG_API_HASH)
+# Extra connections for read-heavy calls (listing photos, downloading media). They
+# reuse the primary client's authorization through an in-memory copy of its session;
+# writes stay on the primary client.
+READ_CLIENT_POOL_SIZE = 4
+read_clients: List[TelegramClient] = []
+read_client_counter = itertools.count()
+# Serializes (re)connects so concurrent requests don't each open a connection.
+connect_lock = asyncio.Lock()
 
 login_state: Dict[str, str] = {}
 
+# Outcome of the last authorization check. The status endpoint and protected
+# endpoints trust it for AUTH_CHECK_TTL seconds instead of asking Telegram each time.
+AUTH_CHECK_TTL = 60
+auth_state = {"authorized": False, "checked_at": 0.0}
+
+# Resolved chat entities keyed by the raw `chat` value sent by the frontend, so
+# usernames aren't re-resolved over MTProto on every request.
+ENTITY_CACHE_SIZE = 1024
+entity_cache: "LRUCache[str, object]" = LRUCache(maxsize=ENTITY_CACHE_SIZE)
+
 
-app_group_cache: List[dict] = []
+# Groups keyed by id, newest first, so creates and deletes don't rebuild a list.
+app_group_cache: "OrderedDict[int, dict]" = OrderedDict()
 cache_lock = asyncio.Lock()
 cache_populated = False
+# Bumped on every change to app_group_cache; used as the /api/my-groups ETag.
+# Seeded from the clock so tags from a previous process never match.
+groups_version = int(time.time())
+# The groups cache is persisted here so restarts don't need a full dialog scan.
+GROUPS_CACHE_FILE = CACHE_DIR / "groups.json"
+
+# Telegram answers bursts with FloodWait, which stalls every user. All data RPCs go
+# through tg_call, which caps how many are in flight; calls that write to Telegram
+# also draw from a token bucket and are rejected with 429 when it runs dry.
+TG_CONCURRENCY = 8
+tg_semaphore = asyncio.Semaphore(TG_CONCURRENCY)
+# File uploads take seconds each, so they get their own slots instead of starving
+# page loads and thumbnail downloads of tg_semaphore.
+UPLOAD_CONCURRENCY = 2
+upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+tg_write_limiter = AsyncLimiter(25, 1)
+
+# Thumbnails are re-encoded from Telegram's JPEG to WebP, which is ~30% smaller.
+# They are written once, with a method that balances encode time against size,
+# since /media serves them as immutable. Pillow builds without libwebp keep JPEG
+# thumbnails instead.
+THUMB_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMB_EXT = ".webp" if THUMB_FORMAT == "WEBP" else ".jpg"
+if THUMB_FORMAT != "WEBP":
+    print("Pillow was built without WebP support; thumbnails are stored as JPEG.")
+THUMB_QUALITY = 75
+THUMB_WEBP_METHOD = 4
+# Longest thumbnail edge: twice the ~220px grid tile, so HiDPI screens stay sharp.
+THUMB_MAX_SIZE = 440
+
+# Thumbnail filenames present in THUMB_DIR, per chat. Loaded with one directory
+# scan on first use so page fetches don't stat() every thumbnail; chats that fall
+# out of the LRU are simply rescanned.
+THUMB_NAMES_CACHE_SIZE = 256
+thumb_names: "LRUCache[int, Set[str]]" = LRUCache(maxsize=THUMB_NAMES_CACHE_SIZE)
+thumb_names_lock = asyncio.Lock()
+
+# Full-size photos are relayed to the browser in chunks of this size while being
+# saved to FULL_DIR; repeat views are served from disk. The least recently viewed
+# files are dropped once the directory grows past FULL_CACHE_MAX_BYTES.
+FULL_PHOTO_CHUNK_SIZE = 256 * 1024
+FULL_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Part files untouched for this long belong to no live download and are deleted by the trim pass.
+FULL_PART_MAX_AGE = 60 * 60
+# At most one trim pass runs at a time; completions during a pass don't queue another.
+full_cache_trimming = False
+# Single-message lookups for one chat arriving within this window share one get_messages call.
+MESSAGE_COALESCE_WINDOW = 0.01
+
+# Pages of /api/photos stored as (page, cached_at, digest) under "chat_id:offset:limit" and
+# tagged with the chat id. Pages older than the TTL are served stale while a
+# background task refreshes them.
+PHOTO_PAGE_TTL = 60
+photo_page_cache = diskcache.Cache(str(CACHE_DIR / "photos"), tag_index=True)
+photo_page_generation: Dict[int, int] = {}
+refreshing_pages: set = set()
+background_tasks: set = set()
+
+
+# Thumbnails are named after their message and never change.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class MediaFiles(StaticFiles):
+    """Static files for /media, with long-lived caching for thumbnails."""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if path.startswith("thumbs/") and response.status_code in (200, 304):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+if MEDIA_ACCEL_REDIRECT_PREFIX:
+    @app.get("/media/{path:path}", include_in_schema=False)
+    async def redirect_media(path: str):
+        if ".." in Path(path).parts:
+            raise HTTPException(status_code=404, detail="Not found.")
+        headers = {"X-Accel-Redirect": MEDIA_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + path}
+        if path.startswith("thumbs/"):
+            headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return Response(headers=headers)
+else:
+    app.mount("/media", MediaFiles(directory="media"), name="media")
+
+
+def _write_file_atomically(path: Path, text: str):
+    tmp_file = path.with_suffix(".tmp")
+    tmp_file.write_text(text)
+    tmp_file.replace(path)
+
+async def _save_group_cache():
+    """Atomically writes the groups cache to disk. Call while holding cache_lock."""
+    # A partial cache (e.g. a create before the first scan) must not be persisted:
+    # the next startup would load it as the complete list.
+    if not cache_populated:
+        return
+    try:
+        await run_in_threadpool(_write_file_atomically, GROUPS_CACHE_FILE, json.dumps(list(app_group_cache.values())))
+    except OSError as e:
+        print(f"Could not save groups cache to {GROUPS_CACHE_FILE}: {e}")
+
+def load_group_cache():
+    """Restores the groups cache saved by a previous run, if any."""
+    global app_group_cache, cache_populated, groups_version
+    if not GROUPS_CACHE_FILE.exists():
+        return
+    try:
+        app_group_cache = OrderedDict((g["id"], g) for g in json.loads(GROUPS_CACHE_FILE.read_text()))
+        cache_populated = True
+        groups_version += 1
+        print(f"Loaded {len(app_group_cache)} groups from {GROUPS_CACHE_FILE}.")
+    except (OSError, ValueError) as e:
+        print(f"Could not load groups cache from {GROUPS_CACHE_FILE}: {e}")
+
+# --- Read client pool ---
+def tg() -> TelegramClient:
+    """Returns the next connected read client in round-robin order, or the primary client."""
+    for _ in range(len(read_clients)):
+        reader = read_clients[next(read_client_counter) % len(read_clients)]
+        if reader.is_connected():
+            return reader
+    return client
+
+async def _ensure_connected():
+    """Connects the primary client if needed, with one connect in flight at a time."""
+    if client.is_connected():
+        return
+    async with connect_lock:
+        if not client.is_connected():
+            await client.connect()
 
+async def _start_read_clients():
+    """Connects the read client pool using a copy of the primary client's session."""
+    await _stop_read_clients()
+    session_string = StringSession.save(client.session)
+    pool = [
+        TelegramClient(StringSession(session_string), TG_API_ID_INT, TG_API_HASH)
+        for _ in range(READ_CLIENT_POOL_SIZE)
+    ]
+    try:
+        await asyncio.gather(*(c.connect() for c in pool))
+    except Exception as e:
+        print(f"Could not start read clients, using the primary client only: {e}")
+        await asyncio.gather(*(c.disconnect() for c in pool), return_exceptions=True)
+        return
+    read_clients[:] = pool
+    print(f"Started {len(pool)} read clients.")
+
+async def _stop_read_clients():
+    pool = read_clients[:]
+    read_clients.clear()
+    await asyncio.gather(*(c.disconnect() for c in pool), return_exceptions=True)
+
+async def connect_clients():
+    """Connects to Telegram and, if a session is already logged in, starts the read pool."""
+    try:
+        await client.connect()
+        if await client.is_user_authorized():
+            _set_authorized(True)
+            await _start_read_clients()
+    except Exception as e:
+        print(f"Could not connect to Telegram on startup: {e}")
 
-app.mount("/media", StaticFiles(directory="media"), name="media")
+async def disconnect_clients():
+    await _stop_read_clients()
+    await client.disconnect()
 
 # --- NEW Authentication Endpoints ---
 
-@app.get("/api/auth/status")
+@app.get("/api/auth/status", response_model=AuthStatus)
 async def get_auth_status():
     """Checks if the client is connected and authorized."""
-    if not client.is_connected():
-        await client.connect()
+    if time.time() - auth_state["checked_at"] < AUTH_CHECK_TTL:
+        return {"is_logged_in": auth_state["authorized"]}
+    await _ensure_connected()
     is_authorized = await client.is_user_authorized()
+    _set_authorized(is_authorized)
     return {"is_logged_in": is_authorized}
 
+def _set_authorized(is_authorized: bool):
+    auth_state["authorized"] = is_authorized
+    auth_state["checked_at"] = time.time()
+
 # UPDATED: Improved error handling for login code requests.
-@app.post("/api/login/send-code")
+@app.post("/api/login/send-code", response_model=StatusResponse)
 async def send_login_code(data: dict):
     """Initiates the login process by sending an OTP code to the user's phone."""
     phone_number = data.get("phone")
@@ -73,8 +331,7 @@ async def send_login_code(data: dict):
         raise HTTPException(status_code=400, detail="Phone number is required.")
     
     try:
-        if not client.is_connected():
-            await client.connect()
+        await _ensure_connected()
         result = await client.send_code_request(phone_number)
         login_state["phone_code_hash"] = result.phone_code_hash
         login_state["phone"] = phone_number
@@ -93,7 +350,7 @@ async def send_login_code(data: dict):
         raise HTTPException(status_code=500, detail=f"Failed to send code: {error_message}")
 
 
-@app.post("/api/login/verify")
+@app.post("/api/login/verify", response_model=StatusResponse, response_model_exclude_none=True)
 async def verify_login(data: dict):
     """Verifies the OTP and password (if needed) to complete the login."""
     code = data.get("code")
@@ -105,12 +362,13 @@ async def verify_login(data: dict):
         raise HTTPException(status_code=400, detail="Missing code, phone, or hash. Please start over.")
 
     try:
-        if not client.is_connected():
-            await client.connect()
+        await _ensure_connected()
         
         await client.sign_in(phone=phone, code=code, phone_code_hash=phone_code_hash)
         
         login_state.clear()
+        _set_authorized(True)
+        await _start_read_clients()
         return {"status": "login_successful"}
 
     except PhoneCodeInvalidError:
@@ -123,26 +381,35 @@ async def verify_login(data: dict):
         try:
             await client.sign_in(password=password)
             login_state.clear()
+            _set_authorized(True)
+            await _start_read_clients()
             return {"status": "login_successful"}
         except Exception as e:
             raise HTTPException(status_code=401, detail=f"Failed to log in with password: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
-@app.post("/api/logout")
+@app.post("/api/logout", response_model=StatusResponse, response_model_exclude_none=True)
 async def logout():
     """Logs the current user out, deletes the session, and prepares for a new login."""
-    global client, cache_populated
+    global client, cache_populated, groups_version
     
+    await _stop_read_clients()
     if client and client.is_connected():
         await client.log_out()
 
-    client = TelegramClient("telegram_session", int(TG_API_ID), TG_API_HASH)
+    client = TelegramClient("telegram_session", TG_API_ID_INT, TG_API_HASH)
     
     login_state.clear()
+    _set_authorized(False)
+    entity_cache.clear()
+    await run_in_threadpool(photo_page_cache.clear)
+    await run_in_threadpool(_remove_files, FULL_DIR.iterdir())
     async with cache_lock:
         app_group_cache.clear()
         cache_populated = False
+        groups_version += 1
+        await run_in_threadpool(GROUPS_CACHE_FILE.unlink, missing_ok=True)
         
     return {"status": "logged_out"}
 
@@ -154,173 +421,554 @@ async def check_auth():
     if not status.get("is_logged_in"):
         raise HTTPException(status_code=401, detail="User is not logged in.")
 
-# --- API Endpoints (with auth checks) ---
-# FIX: Updated get_photos to support pagination (offset, limit) and has_more flag
-@app.get("/api/photos")
-async def get_photos(chat: str, limit: int = 50, offset: int = 0):
-    await check_auth()
-    photos_data = []
+async def tg_call(coro, semaphore: asyncio.Semaphore = tg_semaphore):
+    """Awaits a Telethon call while holding a slot of the shared Telegram semaphore."""
+    async with semaphore:
+        try:
+            return await coro
+        except UnauthorizedError:
+            # The session was revoked; make the next check_auth ask Telegram again.
+            auth_state["checked_at"] = 0.0
+            raise
+
+async def _reserve_write_slot():
+    """Takes a token for a Telegram write, or rejects the request with 429 if none are left."""
+    if not tg_write_limiter.has_capacity():
+        raise HTTPException(
+            status_code=429,
+            detail="Too many changes at once. Please try again in a moment.",
+            headers={"Retry-After": "1"}
+        )
+    await tg_write_limiter.acquire()
+
+def _chat_id_hint(chat: str) -> Optional[int]:
+    """Returns the bare id of a chat without asking Telegram, when it can be derived locally."""
+    entity = entity_cache.get(chat)
+    if entity is not None:
+        return entity.id
     try:
+        # Marked ids such as -100123 map to the bare channel id 123.
+        return utils.resolve_id(int(chat))[0]
+    except ValueError:
+        return None
+
+async def _resolve(chat: str):
+    """Resolves a chat id or username to a Telegram entity, caching the result."""
+    entity = entity_cache.get(chat)
+    if entity is None:
         try:
             chat_entity_input = int(chat)
         except ValueError:
             chat_entity_input = chat
-
-        entity = await client.get_entity(chat_entity_input)
-        numeric_chat_id = entity.id
-
-        # Fetch limit + 1 messages to determine if there are more pages
-        messages_to_check = await client.get_messages(
-            entity,
-            limit=limit + 1,
-            add_offset=offset,
-            filter=InputMessagesFilterPhotos()
+        entity = await tg_call(client.get_entity(chat_entity_input))
+        entity_cache[chat] = entity
+    return entity
+
+def _etag_matches(request: Request, response: Response, etag: str) -> bool:
+    """Tags the response and reports whether the client's cached copy is still current."""
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in (tag.strip() for tag in if_none_match.split(","))
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+# --- Helpers for photo pages ---
+def _spawn(coro):
+    """Runs a coroutine in the background, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def _invalidate_photo_pages(numeric_chat_id: int):
+    """Drops every cached page of a chat; offset pagination shifts all pages on change."""
+    photo_page_generation[numeric_chat_id] = photo_page_generation.get(numeric_chat_id, 0) + 1
+    await run_in_threadpool(photo_page_cache.evict, str(numeric_chat_id))
+
+def _scan_thumb_names(numeric_chat_id: int) -> Set[str]:
+    prefix = f"{numeric_chat_id}_"
+    with os.scandir(THUMB_DIR) as entries:
+        return {e.name for e in entries if e.name.startswith(prefix)}
+
+def _remove_files(paths: Iterable[Path]):
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+def _purge_chat_files(numeric_chat_id: int):
+    """Deletes every cached thumbnail and full-size photo of a chat."""
+    prefix = f"{numeric_chat_id}_"
+    for directory in (THUMB_DIR, FULL_DIR):
+        with os.scandir(directory) as entries:
+            # In-flight part files are left to their download (or the trim pass).
+            paths = [Path(e.path) for e in entries if e.name.startswith(prefix) and not e.name.endswith(".part")]
+        _remove_files(paths)
+
+async def _get_thumb_names(numeric_chat_id: int) -> Set[str]:
+    """Returns the set of thumbnail filenames on disk for a chat."""
+    names = thumb_names.get(numeric_chat_id)
+    if names is None:
+        async with thumb_names_lock:
+            names = thumb_names.get(numeric_chat_id)
+            if names is None:
+                names = await run_in_threadpool(_scan_thumb_names, numeric_chat_id)
+                thumb_names[numeric_chat_id] = names
+    return names
+
+def _thumb_filename(numeric_chat_id: int, message_id) -> str:
+    return f"{numeric_chat_id}_{message_id}{THUMB_EXT}"
+
+def _encode_thumb(data: bytes, path: Path):
+    """Re-encodes a thumbnail downloaded from Telegram as WebP (or JPEG without libwebp)."""
+    with Image.open(io.BytesIO(data)) as img:
+        # Let the JPEG decoder downscale (DCT scaling) before the resampling pass.
+        img.draft("RGB", (THUMB_MAX_SIZE, THUMB_MAX_SIZE))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+        img.thumbnail((THUMB_MAX_SIZE, THUMB_MAX_SIZE), Image.LANCZOS)
+        if THUMB_FORMAT == "WEBP":
+            img.save(path, "WEBP", quality=THUMB_QUALITY, method=THUMB_WEBP_METHOD)
+        else:
+            img.save(path, "JPEG", quality=THUMB_QUALITY, optimize=True)
+
+async def _download_thumb(message, unique_thumb_filename: str, known_thumbs: Set[str]):
+    """Downloads a photo's thumbnail from Telegram and stores it in THUMB_FORMAT."""
+    thumb_image_path = THUMB_DIR / unique_thumb_filename
+    data = await tg_call(message.download_media(thumb=1, file=bytes))
+    await run_in_threadpool(_encode_thumb, data, thumb_image_path)
+    known_thumbs.add(unique_thumb_filename)
+
+def _page_digest(page: dict) -> str:
+    """Content hash of a photo page, used for its ETag."""
+    return hashlib.blake2b(orjson.dumps(page, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+async def _fetch_photo_page(entity, limit: int, offset: int):
+    """Builds a page of photos from Telegram, stores it in the page cache and returns (page, digest)."""
+    numeric_chat_id = entity.id
+    generation = photo_page_generation.get(numeric_chat_id, 0)
+
+    # Fetch limit + 1 messages to determine if there are more pages
+    messages_to_check = await tg_call(tg().get_messages(
+        entity,
+        limit=limit + 1,
+        add_offset=offset,
+        filter=InputMessagesFilterPhotos()
+    ))
+
+    has_more = len(messages_to_check) > limit
+    known_thumbs = await _get_thumb_names(numeric_chat_id)
+
+    # Build each filename once with plain string formatting; Path objects are only
+    # created for thumbnails that actually need downloading.
+    name_prefix = f"{numeric_chat_id}_"
+    photo_entries = [(m, f"{name_prefix}{m.id}{THUMB_EXT}") for m in messages_to_check[:limit] if m.photo]
+    missing = [(m, name) for m, name in photo_entries if name not in known_thumbs]
+
+    # Download missing thumbnails concurrently.
+    failed_names = set()
+    if missing:
+        results = await asyncio.gather(
+            *(_download_thumb(m, name, known_thumbs) for m, name in missing),
+            return_exceptions=True
         )
+        for (message, name), result in zip(missing, results):
+            if isinstance(result, Exception):
+                print(f"Could not download thumbnail for {name}: {result}")
+                failed_names.add(name)
+
+    photos_data = [
+        {"id": str(m.id), "thumb_url": f"/media/thumbs/{name}"}
+        for m, name in photo_entries if name not in failed_names
+    ]
+
+    page = {"photos": photos_data, "has_more": has_more}
+    digest = _page_digest(page)
+    # Skip the write if the chat changed while we were fetching, or if some thumbnails
+    # failed, so the next request retries them instead of serving a short page.
+    if not failed_names and photo_page_generation.get(numeric_chat_id, 0) == generation:
+        key = f"{numeric_chat_id}:{offset}:{limit}"
+        await run_in_threadpool(photo_page_cache.set, key, (page, time.time(), digest), tag=str(numeric_chat_id))
+        # An invalidation may have raced the write; drop what we just stored if so.
+        if photo_page_generation.get(numeric_chat_id, 0) != generation:
+            await run_in_threadpool(photo_page_cache.delete, key)
+    return page, digest
+
+async def _get_cached_photo_page(key: str, numeric_chat_id: int):
+    """Returns (page, cached_at, digest) if the page is cached and all of its thumbnails are on disk."""
+    cached = await run_in_threadpool(photo_page_cache.get, key)
+    # Entries written before the digest was stored are treated as misses.
+    if cached is None or len(cached) != 3:
+        return None
+    page = cached[0]
+    known_thumbs = await _get_thumb_names(numeric_chat_id)
+    name_prefix = f"{numeric_chat_id}_"
+    if any(f"{name_prefix}{photo['id']}{THUMB_EXT}" not in known_thumbs for photo in page["photos"]):
+        return None
+    return cached
+
+async def _refresh_photo_page(chat: str, limit: int, offset: int, key: str):
+    try:
+        entity = await _resolve(chat)
+        await _fetch_photo_page(entity, limit, offset)
+    except Exception as e:
+        print(f"Could not refresh photo page {key}: {e}")
+    finally:
+        refreshing_pages.discard(key)
 
-        has_more = len(messages_to_check) > limit
-        messages_to_process = messages_to_check[:limit]
-
-        for message in messages_to_process:
-            if message.photo:
-                photo_id = str(message.id)
-                unique_thumb_filename = f"{numeric_chat_id}_{photo_id}.jpg"
-                thumb_image_path = THUMB_DIR / unique_thumb_filename
-
-                if not thumb_image_path.exists():
-                    try:
-                        await message.download_media(thumb=1, file=str(thumb_image_path))
-                    except Exception as e:
-                        print(f"Could not download thumbnail for {unique_thumb_filename}: {e}")
-                        continue
-                
-                photos_data.append({"id": photo_id, "thumb_url": f"/media/thumbs/{unique_thumb_filename}"})
+# --- API Endpoints (with auth checks) ---
+# FIX: Updated get_photos to support pagination (offset, limit) and has_more flag
+@app.get("/api/photos", response_model=PhotoPage)
+async def get_photos(request: Request, response: Response, chat: str, limit: int = 50, offset: int = 0):
+    await check_auth()
+    try:
+        numeric_chat_id = _chat_id_hint(chat)
+        if numeric_chat_id is None:
+            numeric_chat_id = (await _resolve(chat)).id
+        key = f"{numeric_chat_id}:{offset}:{limit}"
+
+        # A cached page whose thumbnails are all on disk is served without touching Telegram.
+        cached = await _get_cached_photo_page(key, numeric_chat_id)
+        if cached is not None:
+            page, cached_at, digest = cached
+            if time.time() - cached_at > PHOTO_PAGE_TTL and key not in refreshing_pages:
+                refreshing_pages.add(key)
+                _spawn(_refresh_photo_page(chat, limit, offset, key))
+        else:
+            entity = await _resolve(chat)
+            page, digest = await _fetch_photo_page(entity, limit, offset)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    
-    return {"photos": photos_data, "has_more": has_more}
 
+    etag = f'W/"{numeric_chat_id}-{digest}"'
+    if _etag_matches(request, response, etag):
+        return _not_modified(etag)
+    return page
+
+
+class MessageCoalescer:
+    """Collects message lookups for one chat and resolves them with a single get_messages call.
+
+    Each coalescer serves one batch: it leaves the registry when its window closes, so
+    lookups arriving after that start a new batch.
+    """
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.flush_task = None
+
+    def get(self, message_id: int) -> asyncio.Future:
+        future = self.pending.get(message_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[message_id] = future
+        if self.flush_task is None:
+            self.flush_task = _spawn(self._flush())
+        return future
+
+    async def _flush(self):
+        await asyncio.sleep(MESSAGE_COALESCE_WINDOW)
+        if message_coalescers.get(self.entity.id) is self:
+            del message_coalescers[self.entity.id]
+        message_ids = list(self.pending)
+        try:
+            messages = await tg_call(tg().get_messages(self.entity, ids=message_ids))
+        except Exception as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for message_id, message in zip(message_ids, messages):
+            if not self.pending[message_id].done():
+                self.pending[message_id].set_result(message)
+
+message_coalescers: Dict[int, MessageCoalescer] = {}
+
+async def _get_message(entity, message_id: int):
+    coalescer = message_coalescers.get(entity.id)
+    if coalescer is None:
+        coalescer = message_coalescers[entity.id] = MessageCoalescer(entity)
+    # The future is shared by every request for this message; shield it so one
+    # client disconnecting doesn't cancel the lookup for the others.
+    return await asyncio.shield(coalescer.get(message_id))
+
+def _photo_byte_count(photo) -> Optional[int]:
+    """Returns the size of the largest variant of a photo, which is what iter_download fetches."""
+    size = photo.sizes[-1]
+    if isinstance(size, PhotoSize):
+        return size.size
+    if isinstance(size, PhotoSizeProgressive):
+        return max(size.sizes)
+    return None
+
+def _touch_if_exists(path: Path) -> bool:
+    """Marks a cached file as recently used; returns False if it isn't cached."""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _trim_full_cache():
+    """Deletes the least recently used full-size photos until FULL_DIR fits its budget."""
+    stale_before = time.time() - FULL_PART_MAX_AGE
+    files = []
+    with os.scandir(FULL_DIR) as entries:
+        for e in entries:
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                # Renamed or deleted by a finishing download since the scan.
+                continue
+            if e.name.endswith(".jpg"):
+                files.append((st.st_mtime, st.st_size, e.path))
+            elif e.name.endswith(".part") and st.st_mtime < stale_before:
+                # Left behind by a process that died mid-download.
+                Path(e.path).unlink(missing_ok=True)
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= FULL_CACHE_MAX_BYTES:
+            break
+        Path(path).unlink(missing_ok=True)
+        total -= size
+
+async def _run_full_cache_trim():
+    global full_cache_trimming
+    try:
+        await run_in_threadpool(_trim_full_cache)
+    except OSError as e:
+        print(f"Could not trim full photo cache: {e}")
+    finally:
+        full_cache_trimming = False
+
+def _schedule_full_cache_trim():
+    global full_cache_trimming
+    if not full_cache_trimming:
+        full_cache_trimming = True
+        _spawn(_run_full_cache_trim())
 
 @app.get("/api/photos/{message_id}/full", response_class=StreamingResponse)
 async def get_full_photo(message_id: int, chat: str = Query(...)):
     await check_auth()
     try:
-        chat_entity = int(chat)
-    except ValueError:
-        chat_entity = chat
-    try:
-        message = await client.get_messages(chat_entity, ids=message_id)
+        entity = await _resolve(chat)
+        full_path = FULL_DIR / f"{entity.id}_{message_id}.jpg"
+        if await run_in_threadpool(_touch_if_exists, full_path):
+            return FileResponse(full_path, media_type="image/jpeg")
+
+        message = await _get_message(entity, message_id)
         if not message or not message.photo:
             raise HTTPException(status_code=404, detail="Photo not found.")
-        buffer = io.BytesIO()
-        await message.download_media(file=buffer)
-        buffer.seek(0)
-        return StreamingResponse(buffer, media_type="image/jpeg")
+
+        # Relay chunks as they arrive from Telegram instead of buffering the whole photo,
+        # writing them to a part file that only becomes the cached copy once complete.
+        async def iter_photo():
+            part_path = full_path.with_name(f"{full_path.name}.{uuid.uuid4().hex}.part")
+            part_file = await run_in_threadpool(open, part_path, "wb")
+            completed = False
+            try:
+                async for chunk in message.client.iter_download(message.photo, chunk_size=FULL_PHOTO_CHUNK_SIZE):
+                    await run_in_threadpool(part_file.write, chunk)
+                    yield chunk
+                completed = True
+            finally:
+                # Starlette cancels this generator when the client disconnects, and any
+                # await here would raise straight away; these calls are cheap, so run them inline.
+                part_file.close()
+                if completed:
+                    part_path.replace(full_path)
+                    _schedule_full_cache_trim()
+                else:
+                    part_path.unlink(missing_ok=True)
+
+        headers = {}
+        byte_count = _photo_byte_count(message.photo)
+        if byte_count:
+            headers["Content-Length"] = str(byte_count)
+        return StreamingResponse(iter_photo(), media_type="image/jpeg", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error streaming full photo {message_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/upload")
-async def upload_photo(chat: str = Query(...), file: UploadFile = File(...)):
-    await check_auth()
-    try:
-        chat_entity = int(chat)
-    except ValueError: chat_entity = chat
-    filepath = UPLOADS_DIR / file.filename
+# Telegram rejects photos larger than this; send_file only resizes paths and raw
+# files, not an already-uploaded InputFile, so we do it before upload_file.
+UPLOAD_PHOTO_MAX_SIZE = 2560
+UPLOAD_PHOTO_MAX_BYTES = 10_000_000
+
+def _resize_photo_if_needed(fileobj, filename: str):
+    """Mirrors Telethon's resize for oversized photos; returns the (file, name) to upload."""
+    if not filename or not utils.is_image(filename):
+        return fileobj, filename
+    fileobj.seek(0, io.SEEK_END)
+    file_size = fileobj.tell()
+    fileobj.seek(0)
     try:
-        with open(filepath, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        await client.send_file(chat_entity, filepath, caption="Uploaded from web gallery 🌐")
+        with Image.open(fileobj) as img:
+            if (img.width <= UPLOAD_PHOTO_MAX_SIZE and img.height <= UPLOAD_PHOTO_MAX_SIZE
+                    and file_size <= UPLOAD_PHOTO_MAX_BYTES):
+                return fileobj, filename
+            exif = img.info.get("exif")
+            img.thumbnail((UPLOAD_PHOTO_MAX_SIZE, UPLOAD_PHOTO_MAX_SIZE), Image.LANCZOS)
+            if img.mode == "RGBA":
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[3])
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", progressive=True, **({"exif": exif} if exif else {}))
+    except OSError:
+        # Not something Pillow can decode; let Telegram decide what to do with it.
+        return fileobj, filename
     finally:
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        fileobj.seek(0)
+    buffer.seek(0)
+    return buffer, f"{Path(filename).stem}.jpg"
+
+@app.post("/api/upload", response_model=StatusResponse)
+async def upload_photo(chat: str = Query(...), file: UploadFile = File(...)):
+    await check_auth()
+    await _reserve_write_slot()
+    entity = await _resolve(chat)
+    # Stream the multipart spool straight to Telegram instead of copying it to disk first.
+    # The InputFile keeps the original name, which Telethon uses to send it as a photo.
+    upload_source, upload_name = await run_in_threadpool(_resize_photo_if_needed, file.file, file.filename)
+    uploaded = await tg_call(client.upload_file(upload_source, file_name=upload_name), upload_semaphore)
+    await tg_call(client.send_file(entity, uploaded, caption="Uploaded from web gallery 🌐"))
+    await _invalidate_photo_pages(entity.id)
     return {"status": "success", "message": f"Successfully uploaded {file.filename}."}
 
 
-@app.post("/api/groups")
+@app.post("/api/groups", response_model=GroupCreated)
 async def create_group(group_data: dict):
     await check_auth()
-    global cache_populated
+    global cache_populated, groups_version
     title = group_data.get("title")
     if not title:
         raise HTTPException(status_code=400, detail="Group title is required.")
+    await _reserve_write_slot()
     try:
-        result = await client(CreateChannelRequest(title=title, about="Created via Web Gallery App", megagroup=True))
+        result = await tg_call(client(CreateChannelRequest(title=title, about="Created via Web Gallery App", megagroup=True)))
         created_channel = result.chats[0]
         async with cache_lock:
-            app_group_cache.insert(0, {"id": created_channel.id, "title": created_channel.title})
+            app_group_cache[created_channel.id] = {"id": created_channel.id, "title": created_channel.title}
+            app_group_cache.move_to_end(created_channel.id, last=False)
+            groups_version += 1
+            await _save_group_cache()
         return {"status": "success", "group_id": created_channel.id, "group_title": created_channel.title}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create group: {str(e)}")
 
-@app.get("/api/my-groups")
-async def get_my_groups(offset: int = 0, limit: int = 15, populate_cache_only: bool = False):
+# populate_cache_only requests get an empty (null) body.
+@app.get("/api/my-groups", response_model=Optional[GroupPage])
+async def get_my_groups(request: Request, response: Response, offset: int = 0, limit: int = 15, populate_cache_only: bool = False):
     await check_auth()
-    global cache_populated, app_group_cache
+    global cache_populated, app_group_cache, groups_version
     async with cache_lock:
         if not cache_populated:
             print("Cache is empty. Populating groups cache...")
             app_group_cache.clear()
             try:
-                temp_groups = []
-                async for dialog in client.iter_dialogs():
-                    if isinstance(dialog.entity, Channel) and dialog.entity.megagroup:
-                        try:
-                            full_channel = await client(GetFullChannelRequest(channel=dialog.entity))
-                            if "Created via Web Gallery App" in full_channel.full_chat.about:
-                                temp_groups.append({"id": dialog.id, "title": dialog.name})
-                        except Exception:
-                            continue
-                app_group_cache = temp_groups
+                candidates = [
+                    dialog async for dialog in client.iter_dialogs()
+                    if isinstance(dialog.entity, Channel) and dialog.entity.megagroup
+                ]
+
+                async def is_app_group(dialog) -> bool:
+                    try:
+                        full_channel = await tg_call(client(GetFullChannelRequest(channel=dialog.entity)))
+                    except Exception:
+                        return False
+                    return "Created via Web Gallery App" in (full_channel.full_chat.about or "")
+
+                # Probe the candidates concurrently; gather keeps the dialog order.
+                matches = await asyncio.gather(*(is_app_group(d) for d in candidates))
+                temp_groups = [
+                    {"id": dialog.id, "title": dialog.name}
+                    for dialog, matched in zip(candidates, matches) if matched
+                ]
+                app_group_cache = OrderedDict((g["id"], g) for g in temp_groups)
                 cache_populated = True
+                groups_version += 1
+                await _save_group_cache()
                 print(f"Cache populated with {len(app_group_cache)} groups.")
             except Exception as e:
                 cache_populated = False; app_group_cache.clear()
                 if populate_cache_only: return
                 raise HTTPException(status_code=500, detail=f"Failed to build groups cache: {str(e)}")
     if populate_cache_only: return
-    paginated_groups = app_group_cache[offset : offset + limit]
+    etag = f'W/"{groups_version}-{offset}-{limit}"'
+    if _etag_matches(request, response, etag):
+        return _not_modified(etag)
+    paginated_groups = list(itertools.islice(app_group_cache.values(), offset, offset + limit))
     has_more = len(app_group_cache) > offset + limit
     return {"groups": paginated_groups, "has_more": has_more}
 
 
-@app.delete("/api/groups/{group_id}")
+@app.delete("/api/groups/{group_id}", response_model=StatusResponse)
 async def delete_group(group_id: int):
     await check_auth()
-    global cache_populated
+    global cache_populated, groups_version
+    await _reserve_write_slot()
     try:
-        await client(DeleteChannelRequest(channel=group_id))
+        await tg_call(client(DeleteChannelRequest(channel=group_id)))
+        entity_cache.pop(str(group_id), None)
+        # Cached pages and files are keyed by the bare channel id, not the marked -100… id.
+        numeric_chat_id = utils.resolve_id(group_id)[0]
+        thumb_names.pop(numeric_chat_id, None)
+        await _invalidate_photo_pages(numeric_chat_id)
+        await run_in_threadpool(_purge_chat_files, numeric_chat_id)
         async with cache_lock:
-            app_group_cache[:] = [g for g in app_group_cache if g.get("id") != group_id]
+            app_group_cache.pop(group_id, None)
+            groups_version += 1
+            await _save_group_cache()
         return {"status": "success", "message": f"Group {group_id} has been deleted."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete group: {str(e)}")
 
 
-@app.delete("/api/photos/{message_id}")
-async def delete_photo(message_id: int, chat: str = Query(...)):
+async def _delete_photos(chat: str, message_ids: List[int]):
+    """Deletes photos with a single Telegram call and drops their cached thumbnails."""
+    entity = await _resolve(chat)
+    numeric_chat_id = entity.id
+
+    await tg_call(client.delete_messages(entity, message_ids))
+    await _invalidate_photo_pages(numeric_chat_id)
+
+    known_thumbs = await _get_thumb_names(numeric_chat_id)
+    stale_thumbs = []
+    for message_id in message_ids:
+        unique_thumb_filename = _thumb_filename(numeric_chat_id, message_id)
+        if unique_thumb_filename in known_thumbs:
+            known_thumbs.discard(unique_thumb_filename)
+            stale_thumbs.append(THUMB_DIR / unique_thumb_filename)
+    stale_fulls = [FULL_DIR / f"{numeric_chat_id}_{message_id}.jpg" for message_id in message_ids]
+    await run_in_threadpool(_remove_files, stale_thumbs + stale_fulls)
+
+@app.post("/api/photos/bulk-delete", response_model=PhotosDeleted)
+async def bulk_delete_photos(ids: List[int], chat: str = Query(...)):
     await check_auth()
+    if not ids:
+        raise HTTPException(status_code=400, detail="At least one photo id is required.")
+    await _reserve_write_slot()
     try:
-        try:
-            chat_entity_input = int(chat)
-        except ValueError:
-            chat_entity_input = chat
-
-        entity = await client.get_entity(chat_entity_input)
-        numeric_chat_id = entity.id
-        
-        await client.delete_messages(entity, [message_id])
-        
-        photo_id = str(message_id)
+        await _delete_photos(chat, ids)
+        return {"status": "success", "deleted": len(ids)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete photos: {str(e)}")
 
-        unique_thumb_filename = f"{numeric_chat_id}_{photo_id}.jpg"
-        thumb_image_path = THUMB_DIR / unique_thumb_filename
 
-        if thumb_image_path.exists():
-            os.remove(thumb_image_path)
-            
+@app.delete("/api/photos/{message_id}", response_model=StatusResponse)
+async def delete_photo(message_id: int, chat: str = Query(...)):
+    await check_auth()
+    await _reserve_write_slot()
+    try:
+        await _delete_photos(chat, [message_id])
         return {"status": "success", "message": f"Photo {message_id} deleted."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete photo {message_id}: {str(e)}")